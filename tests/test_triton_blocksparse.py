@@ -29,6 +29,11 @@ if _triton_available:
         from triton.ops.blocksparse import softmax as blocksparse_softmax
 
         from xformers.components.attention import BlockSparseAttention
+        from xformers.components.attention.blocksparse import _KERNEL_CACHE_SIZE
+        from xformers.triton.blocksparse_attention import build_block_lut
+        from xformers.triton.blocksparse_softmax import (
+            blocksparse_softmax as masked_blocksparse_softmax,
+        )
         from xformers.triton.utils import (
             assert_almost_equal,
             gpu_capabilities_older_than_70,
@@ -43,6 +48,30 @@ if _triton_available:
         _triton_available = False
 
 
+def _make_layout(pattern: str, H: int, rows: int, cols: int):
+    """
+    Block layouts for the tests:
+    - random: about half of the blocks, no structure
+    - local_strided: causal, dense local window and strided global columns (Phi-3-small style, scaled down)
+    - causal_tril: causal, dense lower triangle
+    """
+    if pattern == "random":
+        return torch.randint(2, (H, rows, cols))
+
+    i = torch.arange(rows)[:, None]
+    j = torch.arange(cols)[None, :]
+    if pattern == "local_strided":
+        # scaled with the layout, so that the pattern never degenerates into causal_tril
+        local_blocks, vert_stride = max(rows // 4, 1), max(rows // 8, 2)
+        layout = ((i - j) < local_blocks) | ((j + 1) % vert_stride == 0)
+    elif pattern == "causal_tril":
+        layout = torch.ones(rows, cols, dtype=torch.bool)
+    else:
+        raise ValueError(f"Unknown layout pattern {pattern}")
+
+    return (layout & (j <= i)).long().unsqueeze(0).repeat(H, 1, 1)
+
+
 @pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
 @pytest.mark.skipif(
     not _triton_available or get_current_cuda_device() == "T4",
@@ -53,7 +82,10 @@ if _triton_available:
 @pytest.mark.parametrize("TRANS_B", [False, True])
 @pytest.mark.parametrize("BLOCK", [16, 32, 64])
 @pytest.mark.parametrize("DTYPE", [torch.float16])
-def test_matmul(MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K=256):
+@pytest.mark.parametrize("pattern", ["random", "local_strided", "causal_tril"])
+def test_matmul(
+    pattern, MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K=256
+):
     # set seed
     torch.random.manual_seed(0)
 
@@ -69,7 +101,7 @@ def test_matmul(MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K
         "dsd": (a.shape[2], a.shape[3]),
         "dds": (b.shape[2], b.shape[3]),
     }[MODE]
-    layout = torch.randint(2, (H, shape[0] // BLOCK, shape[1] // BLOCK))
+    layout = _make_layout(pattern, H, shape[0] // BLOCK, shape[1] // BLOCK)
 
     # triton result
     op = blocksparse_matmul(
@@ -101,14 +133,15 @@ def test_matmul(MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K
 @pytest.mark.parametrize("BLOCK", [32, 128])
 @pytest.mark.parametrize("WIDTH", [256, 576, 1024, 1792])
 @pytest.mark.parametrize("DTYPE", [torch.float16, torch.float32])
-def test_softmax(BLOCK, WIDTH, DTYPE):
+@pytest.mark.parametrize("pattern", ["random", "local_strided", "causal_tril"])
+def test_softmax(pattern, BLOCK, WIDTH, DTYPE):
     # set seed
     torch.random.manual_seed(0)
     Z, H, M, N = 2, 4, WIDTH, WIDTH
     scale = 0.4
 
     # create inputs
-    layout = torch.randint(2, (H, M // BLOCK, N // BLOCK))
+    layout = _make_layout(pattern, H, M // BLOCK, N // BLOCK)
     x = torch.randn((Z, H, M, N), dtype=DTYPE, requires_grad=True, device="cuda")
 
     # triton result
@@ -125,6 +158,59 @@ def test_softmax(BLOCK, WIDTH, DTYPE):
     # compare
     assert_almost_equal(ry, ty)
 
+    # same computation, through the block LUT
+    lut = build_block_lut(layout, device="cuda")
+    ty_lut = masked_blocksparse_softmax(tx, None, lut, BLOCK, scale=scale)
+    assert_almost_equal(ry, ty_lut)
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("mask_heads", [0, 1, 4])
+@pytest.mark.parametrize("BLOCK", [16, 64])
+def test_softmax_masked(BLOCK, mask_heads, causal, Z=2, H=4, WIDTH=512):
+    torch.random.manual_seed(0)
+    scale, mask_scale = 0.4, 2.0
+
+    layout = torch.randint(2, (H, WIDTH // BLOCK, WIDTH // BLOCK))
+    layout[:, :, 0] = 1
+    x = torch.randn((Z, H, WIDTH, WIDTH), dtype=torch.float16, device="cuda")
+    mask = (
+        torch.randn((Z, mask_heads, 1, WIDTH), dtype=torch.float16, device="cuda")
+        if mask_heads > 0
+        else None
+    )
+
+    # triton result, the mask being fused in the softmax
+    tx = block_sparsify_tensor(x, layout, BLOCK).requires_grad_()
+    ty = masked_blocksparse_softmax(
+        tx,
+        mask,
+        build_block_lut(layout, device="cuda"),
+        BLOCK,
+        scale=scale,
+        mask_scale=mask_scale,
+        causal=causal,
+    )
+    ty.backward(torch.ones_like(ty).cumsum(-1))
+
+    # torch result
+    rx = x.float().requires_grad_()
+    scores = rx * scale
+    if mask is not None:
+        scores = scores + mask.float() * mask_scale
+    scores = triton.testing.mask_tensor(scores, layout, BLOCK, value=float("-inf"))
+    if causal:
+        scores = scores.masked_fill(
+            torch.ones(WIDTH, WIDTH, device="cuda").triu(1).bool(), float("-inf")
+        )
+    ry = torch.softmax(scores, -1).nan_to_num(0.0)
+    ry_sparse = block_sparsify_tensor(ry, layout, BLOCK)
+    ry_sparse.backward(torch.ones_like(ry_sparse).cumsum(-1))
+
+    assert_almost_equal(ry_sparse, ty.float())
+    assert_almost_equal(block_sparsify_tensor(rx.grad, layout, BLOCK), tx.grad.float())
+
 
 @pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
 @pytest.mark.parametrize("block", [32, 43, 128])  # 16, 32,
@@ -267,3 +353,317 @@ def test_blocksparse_attention_parity():
 
     # FIXME: currently has max diff of .009, perhaps can be improved.
     assert_almost_equal(r_sdp, r_blocksparse)
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("mask_heads", [0, 1, 2])
+@pytest.mark.parametrize("block", [16, 32, 64])
+def test_blocksparse_attention_fused(
+    block, mask_heads, causal, batch_size=2, n_heads=2, n_ctx=256, head_dim=64
+):
+    torch.manual_seed(0)
+    scale = 0.5
+
+    qkv_shape = (batch_size, n_heads, n_ctx, head_dim)
+    qkvs = [
+        torch.randn(qkv_shape, device="cuda", dtype=torch.float16) for _ in range(3)
+    ]
+    att_mask = (
+        torch.randint(0, 2, [batch_size, mask_heads, 1, n_ctx], device="cuda").bool()
+        if mask_heads > 0
+        else None
+    )
+
+    n_blocks = n_ctx // block
+    layout = torch.randint(2, (n_heads, n_blocks, n_blocks))
+
+    # Triton, fused path
+    query, key, value = [x.clone().requires_grad_() for x in qkvs]
+    block_sparse_attention = BlockSparseAttention(layout, block, causal=causal)
+    attn_out = block_sparse_attention(
+        q=query, k=key, v=value, scale=scale, att_mask=att_mask
+    )
+    attn_out.norm().backward()
+
+    # Torch version, dense and masked
+    torch_q, torch_k, torch_v = [x.clone().float().requires_grad_() for x in qkvs]
+    scores = torch.einsum("bhsd,bhtd->bhst", torch_q, torch_k) / math.sqrt(head_dim)
+    if att_mask is not None:
+        scores = scores + 1e6 * (-1.0 + att_mask.float())
+    scores = scale * scores
+
+    dense_layout = layout.repeat_interleave(block, -1).repeat_interleave(block, -2)
+    scores = scores.masked_fill(dense_layout.cuda() == 0, float("-inf"))
+    if causal:
+        scores = scores.masked_fill(
+            torch.ones(n_ctx, n_ctx, device="cuda").triu(1).bool(), float("-inf")
+        )
+
+    # Rows without any active block are zeroed out, same as the sparse matmuls
+    probs = torch.softmax(scores, dim=-1).nan_to_num(0.0)
+    torch_attn_out = torch.einsum("bhst,bhtd->bhsd", probs, torch_v)
+    torch_attn_out.norm().backward()
+
+    assert_almost_equal(attn_out.float(), torch_attn_out)
+    for g1, g2 in zip(
+        [query.grad, key.grad, value.grad], [torch_q.grad, torch_k.grad, torch_v.grad]
+    ):
+        assert_almost_equal(g1.float(), g2)
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("mask_heads", [1, 2])
+def test_blocksparse_attention_ops_path(
+    monkeypatch, mask_heads, causal, batch_size=2, n_heads=2, n_ctx=256, block=32
+):
+    torch.manual_seed(0)
+    scale = 0.5
+
+    qkv_shape = (batch_size, n_heads, n_ctx, 64)
+    qkvs = [
+        torch.randn(qkv_shape, device="cuda", dtype=torch.float16) for _ in range(3)
+    ]
+    att_mask = torch.randint(
+        0, 2, [batch_size, mask_heads, 1, n_ctx], device="cuda"
+    ).bool()
+
+    n_blocks = n_ctx // block
+    layout = torch.randint(2, (n_heads, n_blocks, n_blocks))
+    block_sparse_attention = BlockSparseAttention(layout, block, causal=causal)
+
+    def attend():
+        query, key, value = [x.clone().requires_grad_() for x in qkvs]
+        attn_out = block_sparse_attention(
+            q=query, k=key, v=value, scale=scale, att_mask=att_mask
+        )
+        attn_out.norm().backward()
+        return attn_out, query.grad, key.grad, value.grad
+
+    # Reference, fused path
+    fused = attend()
+
+    # Blocksparse matmuls and masked softmax, as used with dropout or unsupported head dimensions
+    monkeypatch.setattr(
+        BlockSparseAttention, "_use_fused_kernel", lambda self, q: False
+    )
+    ops = attend()
+
+    for t1, t2 in zip(ops, fused):
+        assert_almost_equal(t1, t2)
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("transpose", [False, True])
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("n_blocks", [7, 64, 200])
+def test_build_block_lut(n_blocks, causal, transpose):
+    torch.manual_seed(0)
+    layout = torch.randint(2, (3, n_blocks, n_blocks))
+
+    lut_cpu = build_block_lut(layout, causal, transpose=transpose, device="cpu")
+    lut_gpu = build_block_lut(layout, causal, transpose=transpose, device="cuda")
+
+    for ref, res in zip(lut_cpu, lut_gpu):
+        assert torch.equal(ref, res.cpu())
+
+    # the kernels are scheduled heaviest first
+    _, _, lut_count, lut_order = lut_cpu
+    ordered_count = lut_count.gather(-1, lut_order.long())
+    assert (ordered_count[:, :-1] >= ordered_count[:, 1:]).all()
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+def test_blocksparse_kernel_cache():
+    layout = torch.tril(torch.ones([2, 4, 4], dtype=torch.long))
+
+    attentions = [BlockSparseAttention(layout, 32) for _ in range(2)]
+    for attention in attentions:
+        attention.create_triton_kernels(torch.device("cuda"))
+
+    # Same layout, the kernels are shared
+    assert attentions[0].sparse_dot_sdd is attentions[1].sparse_dot_sdd
+    assert attentions[0].softmax_lut is attentions[1].softmax_lut
+
+    # Different layout, new kernels
+    other = BlockSparseAttention(torch.ones([2, 4, 4], dtype=torch.long), 32)
+    other.create_triton_kernels(torch.device("cuda"))
+    assert other.sparse_dot_sdd is not attentions[0].sparse_dot_sdd
+
+    # Only the last layouts are kept around
+    for i in range(_KERNEL_CACHE_SIZE):
+        other = BlockSparseAttention(torch.ones([3 + i, 4, 4], dtype=torch.long), 32)
+        other.create_triton_kernels(torch.device("cuda"))
+
+    evicted = BlockSparseAttention(layout, 32)
+    evicted.create_triton_kernels(torch.device("cuda"))
+    assert evicted.sparse_dot_sdd is not attentions[0].sparse_dot_sdd
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("n_queries", [1, 5, 32])
+@pytest.mark.parametrize("dense_layout", [False, True])
+def test_blocksparse_attention_decode(
+    dense_layout, n_queries, causal, batch_size=2, n_heads=2, n_ctx=512, block=16
+):
+    torch.manual_seed(0)
+
+    # A sparse layout goes through the padded sparse kernel, a dense one through dense attention
+    n_blocks = n_ctx // block
+    layout = (
+        torch.ones([n_heads, n_blocks, n_blocks], dtype=torch.long)
+        if dense_layout
+        else torch.eye(n_blocks, dtype=torch.long).unsqueeze(0).repeat(n_heads, 1, 1)
+    )
+    layout[:, :, 0] = 1
+
+    q, k, v = [
+        torch.randn(
+            (batch_size, n_heads, n_ctx, 64), device="cuda", dtype=torch.float16
+        )
+        for _ in range(3)
+    ]
+    att_mask = torch.randint(0, 2, [batch_size, 1, 1, n_ctx], device="cuda").bool()
+    att_mask[..., 0] = True
+
+    attention = BlockSparseAttention(layout, block, causal=causal)
+    with torch.no_grad():
+        full = attention(q=q, k=k, v=v, att_mask=att_mask)
+        decoded = attention(q=q[:, :, -n_queries:], k=k, v=v, att_mask=att_mask)
+
+    assert decoded.shape[-2] == n_queries
+    assert_almost_equal(full[:, :, -n_queries:], decoded)
+
+    # Outside of decoding, the keys have to cover the whole layout
+    with pytest.raises(ValueError):
+        attention(q=q[:, :, 1:], k=k[:, :, 1:], v=v[:, :, 1:])
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("kv_len", [200, 256])
+@pytest.mark.parametrize("n_queries", [1, 5])
+@pytest.mark.parametrize("dense_layout", [False, True])
+def test_blocksparse_attention_decode_kv_cache(
+    dense_layout,
+    n_queries,
+    kv_len,
+    causal,
+    batch_size=2,
+    n_heads=2,
+    n_ctx=512,
+    block=16,
+):
+    torch.manual_seed(0)
+
+    # The KV cache is shorter than the layout, a sparse layout goes through the fused kernel,
+    # a dense one through dense attention
+    n_blocks = n_ctx // block
+    layout = (
+        torch.ones([n_heads, n_blocks, n_blocks], dtype=torch.long)
+        if dense_layout
+        else torch.eye(n_blocks, dtype=torch.long).unsqueeze(0).repeat(n_heads, 1, 1)
+    )
+    layout[:, :, 0] = 1
+
+    q = torch.randn(
+        (batch_size, n_heads, n_queries, 64), device="cuda", dtype=torch.float16
+    )
+    k, v = [
+        torch.randn(
+            (batch_size, n_heads, kv_len, 64), device="cuda", dtype=torch.float16
+        )
+        for _ in range(2)
+    ]
+    att_mask = torch.randint(0, 2, [batch_size, 1, 1, kv_len], device="cuda").bool()
+    att_mask[..., 0] = True
+
+    attention = BlockSparseAttention(layout, block, causal=causal)
+    with torch.no_grad():
+        decoded = attention(q=q, k=k, v=v, att_mask=att_mask)
+
+    # Torch version, the queries being the last positions of the KV cache
+    positions = torch.arange(kv_len - n_queries, kv_len, device="cuda")
+    allowed = (
+        layout.cuda()
+        .repeat_interleave(block, -1)
+        .repeat_interleave(block, -2)[:, positions, :kv_len]
+        .bool()
+    )
+    if causal:
+        allowed = allowed & (
+            torch.arange(kv_len, device="cuda")[None, :] <= positions[:, None]
+        )
+
+    scores = q.float() @ k.float().transpose(-2, -1) / math.sqrt(64)
+    scores = scores.masked_fill(~att_mask, float("-inf")).masked_fill(
+        ~allowed, float("-inf")
+    )
+    probs = torch.softmax(scores, dim=-1).nan_to_num(0.0)
+
+    assert decoded.shape == q.shape
+    assert_almost_equal(decoded.float(), probs @ v.float())
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("block", [16, 64])
+def test_blocksparse_attention_kv_quant(
+    block, causal, batch_size=2, n_heads=2, n_ctx=512
+):
+    torch.manual_seed(0)
+
+    n_blocks = n_ctx // block
+    layout = torch.randint(0, 2, [n_heads, n_blocks, n_blocks])
+    layout[:, :, 0] = 1
+    layout[:, torch.arange(n_blocks), torch.arange(n_blocks)] = 1
+
+    q, k, v = [
+        torch.randn(
+            (batch_size, n_heads, n_ctx, 64), device="cuda", dtype=torch.float16
+        )
+        for _ in range(3)
+    ]
+
+    reference = BlockSparseAttention(layout, block, causal=causal)
+    quantized = BlockSparseAttention(layout, block, causal=causal, kv_quant="int8")
+
+    with torch.no_grad():
+        expected = reference(q=q, k=k, v=v)
+
+        # K/V are quantized once, then reused
+        k_q, v_q, kv_scales = quantized.quantize_kv(k, v)
+        assert k_q.dtype == v_q.dtype == torch.int8
+        res = quantized(q=q, k=k_q, v=v_q, kv_scales=kv_scales)
+        decoded = quantized(q=q[:, :, -5:], k=k_q, v=v_q, kv_scales=kv_scales)
+
+    # int8 quantization error, per block
+    assert torch.allclose(expected, res, atol=5e-2, rtol=0.0)
+    assert torch.allclose(expected[:, :, -5:], decoded, atol=5e-2, rtol=0.0)
+
+
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+def test_blocksparse_mask_conversion_cache(n_ctx=256, block=32):
+    layout = torch.ones([2, n_ctx // block, n_ctx // block], dtype=torch.long)
+    attention = BlockSparseAttention(layout, block)
+
+    mask = torch.ones([2, 1, 1, n_ctx], dtype=torch.bool, device="cuda")
+    mask[..., -1] = False
+
+    # Same mask, the conversion is reused
+    additive = attention.update_mask_type(mask)
+    assert additive.dtype == torch.float16
+    assert additive[..., 0].eq(0.0).all() and additive[..., -1].eq(float("-inf")).all()
+    assert attention.update_mask_type(mask) is additive
+
+    # The mask is modified in place, it is converted again
+    mask[..., 0] = False
+    updated = attention.update_mask_type(mask)
+    assert updated is not additive
+    assert updated[..., 0].eq(float("-inf")).all()
+
+    # The mask is not held onto by the attention
+    del mask
+    assert attention._bool_mask_ref() is None
@@ -6,18 +6,28 @@
 
 import logging
 import math
+import os
+import weakref
+from collections import OrderedDict
 from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
 
 import torch
 
 from xformers import _is_triton_available
 from xformers.components.attention import Attention, AttentionConfig, register_attention
-from xformers.components.attention.utils import bool_mask_to_additive
 
 if _is_triton_available:
     from triton.ops.blocksparse import matmul as blocksparse_matmul  # type: ignore
-    from triton.ops.blocksparse import softmax as blocksparse_softmax  # type: ignore
 
+    from xformers.triton.blocksparse_attention import (
+        SUPPORTED_HEAD_DIMS,
+        _to_device,
+        blocksparse_attention,
+        build_block_lut,
+        quantize_kv_blocks,
+    )
+    from xformers.triton.blocksparse_softmax import blocksparse_softmax
     from xformers.triton.utils import gpu_capabilities_older_than_70
 
     # Blocksparse requires Tensor cores
@@ -30,6 +40,23 @@ if _is_triton_available:
 
 if _is_triton_available:
 
+    def _to_half(x: torch.Tensor) -> torch.Tensor:
+        return x if x.dtype == torch.float16 else x.half()
+
+    # Kernels and lookup tables, shared in between the instances with the same layout.
+    # Least recently used first, only the last few layouts are kept so that their device buffers can be freed
+    _KERNEL_CACHE: "OrderedDict[Tuple, Tuple]" = OrderedDict()
+    _KERNEL_CACHE_SIZE = 8
+
+    # Opt-in, torch.compile (with CUDA graphs) the Python code in between the kernels.
+    # Needs a recent PyTorch, and a Triton version compatible with it
+    _USE_TORCH_COMPILE = os.environ.get("XFORMERS_BSR_COMPILE", "0") == "1" and hasattr(
+        torch, "compile"
+    )
+
+    # Below this sparsity of the live layout rows, dense attention is faster when decoding
+    _DECODE_SPARSITY_THRESHOLD = 0.8
+
     @dataclass
     class BlockSparseAttentionConfig(AttentionConfig):
         layout: torch.Tensor  # The dimensions of the random features
@@ -51,6 +78,19 @@ if _is_triton_available:
         .. warning: the block size has to be picked from [16, 32, 64]. Some speed is gained from bigger blocks.
             It is of course possible to reproduce coarser patterns given these primitives, as the user sees fit.
 
+        .. note: when possible (no dropout and a head dimension in [16, 32, 64, 128]), a fused kernel is used,
+            which never materializes the attention matrix. The three separate blocksparse operations are used otherwise.
+            Its launch parameters can be autotuned by setting `XFORMERS_BSR_AUTOTUNE=1`.
+            Setting `XFORMERS_BSR_COMPILE=1` wraps the computations in between the kernels in `torch.compile`.
+
+        .. note: the queries can be shorter than the keys (decoding), in which case they are aligned with the end
+            of the keys. The keys can then also be shorter than the layout, for instance a KV cache being filled.
+            Dense attention is used if the live rows of the layout are not sparse enough.
+
+        .. note: with `kv_quant="int8"`, K and V can be quantized per block once (for instance a KV cache),
+            through `quantize_kv`, and passed to `forward` alongside their scales. The fused kernel then reads
+            int8 K/V blocks, halving their memory traffic. This is only supported for inference.
+
         """
 
         def __init__(
@@ -60,6 +100,7 @@ if _is_triton_available:
             dropout: float = 0.0,
             num_heads: int = 1,  # optional, used to adapt the layout if in need
             causal: bool = False,
+            kv_quant: Optional[str] = None,
             *args,
             **kwargs,
         ):
@@ -80,35 +121,72 @@ if _is_triton_available:
                 128,
             ), "Only block sizes in [16, 32, 64, 128] are supported"
 
+            assert kv_quant in (
+                None,
+                "int8",
+            ), f"Unsupported K/V quantization {kv_quant}, use one of [None, 'int8']"
+
             super().__init__()
 
             self.causal = causal
+            self.kv_quant = kv_quant
 
-            self.attn_drop = torch.nn.Dropout(dropout, inplace=False)
+            # No dropout module at all if not needed, saves a call per forward
+            self._dropout_p = dropout
+            self.attn_drop = (
+                torch.nn.Dropout(dropout, inplace=False) if dropout > 0.0 else None
+            )
 
             # Pure blocksparse data
             self.layout = layout
             self.block_size = block_size
+            self._seq_len = layout.shape[-2] * block_size
 
             # make sure that the head dimension is not folded down with the batch
             self.requires_head_dimension = True
 
             # key padding mask and attention mask must be passed in separately
+            # NOTE: queries shorter than the keys are supported when decoding, see `forward`
             self.requires_same_k_q_dimensions = True
 
+            # sparsity of the live layout rows when decoding, per range of row blocks
+            self._decode_sparsity: Dict[Tuple[int, int], float] = {}
+
+            # last boolean mask (weakly referenced) and its additive counterpart, see `update_mask_type`
+            self._bool_mask_ref: Optional[weakref.ref] = None
+            self._bool_mask_key: Optional[Tuple] = None
+            self._additive_mask: Optional[torch.Tensor] = None
+
             # The underlying triton op does not support per element attention mask
             self.supports_attention_mask = True
             self.supports_key_padding_mask = False
 
         def update_mask_type(self, mask: torch.Tensor):
-            logging.warning(
-                "Mask has to be additive. Fixing that but this slows things down"
-            )
-            return bool_mask_to_additive(mask)
-
-        def create_triton_kernels(self, device):
+            # Masks are often static in between calls, only convert them once.
+            # NOTE: This relies on the private `Tensor._version` counter, bumped by the in-place updates,
+            # to catch a mask being modified in between calls. The mask is only weakly referenced,
+            # and the cached conversion is dropped as soon as it is freed.
+            # This is plain Python logic, which torch.compile does not trace through (graph break)
+            key = (mask.data_ptr(), tuple(mask.shape), mask._version)
+            if (
+                self._bool_mask_ref is not None
+                and self._bool_mask_ref() is mask
+                and key == self._bool_mask_key
+            ):
+                return self._additive_mask
+
+            # Direct conversion to a fp16 additive mask, no intermediate fp32 buffer
+            additive_mask = torch.full(
+                mask.shape, float("-inf"), dtype=torch.float16, device=mask.device
+            ).masked_fill_(mask, 0.0)
+
+            self._bool_mask_ref, self._bool_mask_key = weakref.ref(mask), key
+            self._additive_mask = additive_mask
+            return additive_mask
+
+        def _build_triton_kernels(self, device):
             # blocksparse operators
-            self.sparse_dot_sdd = blocksparse_matmul(
+            sparse_dot_sdd = blocksparse_matmul(
                 self.layout,
                 self.block_size,
                 "sdd",
@@ -117,7 +195,7 @@ if _is_triton_available:
                 device=device,
             )
 
-            self.sparse_dot_dsd = blocksparse_matmul(
+            sparse_dot_dsd = blocksparse_matmul(
                 self.layout,
                 self.block_size,
                 "dsd",
@@ -126,26 +204,195 @@ if _is_triton_available:
                 device=device,
             )
 
-            self.sparse_softmax = blocksparse_softmax(
-                self.layout,
+            # ragged lookup tables for the fused kernel, row and column wise
+            row_lut = build_block_lut(self.layout, self.causal, device=device)
+            col_lut = build_block_lut(
+                self.layout, self.causal, transpose=True, device=device
+            )
+
+            # the blocksparse softmax goes over all the blocks of the sparse attention matrix, causal or not
+            softmax_lut = (
+                build_block_lut(self.layout, device=device) if self.causal else row_lut
+            )
+
+            # dense layout, used when decoding with a dense fallback
+            device_layout = _to_device(self.layout != 0, device)
+
+            return (
+                sparse_dot_sdd,
+                sparse_dot_dsd,
+                row_lut,
+                col_lut,
+                softmax_lut,
+                device_layout,
+            )
+
+        def create_triton_kernels(self, device):
+            # All the layers of a model typically share the same layout, build the kernels only once
+            key = (
+                tuple(self.layout.shape),
+                hash(self.layout.cpu().numpy().tobytes()),
                 self.block_size,
-                device=device,
+                str(device),
+                self.causal,
+            )
+
+            if key in _KERNEL_CACHE:
+                _KERNEL_CACHE.move_to_end(key)
+            else:
+                _KERNEL_CACHE[key] = self._build_triton_kernels(device)
+                if len(_KERNEL_CACHE) > _KERNEL_CACHE_SIZE:
+                    _KERNEL_CACHE.popitem(last=False)
+
+            (
+                self.sparse_dot_sdd,
+                self.sparse_dot_dsd,
+                self.row_lut,
+                self.col_lut,
+                self.softmax_lut,
+                self.device_layout,
+            ) = _KERNEL_CACHE[key]
+
+            # Optionally capture the Python glue in between the kernels, see _USE_TORCH_COMPILE
+            self._compiled_forward = (
+                torch.compile(
+                    self._forward_impl,
+                    mode="reduce-overhead",
+                    fullgraph=False,
+                    dynamic=False,
+                )
+                if _USE_TORCH_COMPILE
+                else self._forward_impl
+            )
+
+        def flash_blocksparse_fwd(
+            self,
+            q: torch.Tensor,
+            k: torch.Tensor,
+            v: torch.Tensor,
+            att_mask: Optional[torch.Tensor],
+            scale: float,
+            kv_scales: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        ) -> torch.Tensor:
+            return blocksparse_attention(
+                q,
+                k,
+                v,
+                att_mask,
+                self.row_lut,
+                self.col_lut,
+                self.block_size,
+                scale=scale,
+                causal=self.causal,
+                kv_scales=kv_scales,
+            )
+
+        def quantize_kv(
+            self, k: torch.Tensor, v: torch.Tensor
+        ) -> Tuple[torch.Tensor, torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+            """
+            Quantize K and V per block, to be passed to `forward` alongside the returned scales.
+            This is meant to be done once, for instance when filling a KV cache.
+            """
+            assert self.kv_quant == "int8", "K/V quantization is not enabled"
+
+            k_q, k_scale = quantize_kv_blocks(k, self.block_size)
+            v_q, v_scale = quantize_kv_blocks(v, self.block_size)
+            return k_q, v_q, (k_scale, v_scale)
+
+        def _use_fused_kernel(self, q: torch.Tensor) -> bool:
+            # The fused kernel does not handle dropout
+            return q.shape[-1] in SUPPORTED_HEAD_DIMS and (
+                self._dropout_p == 0.0 or not self.training
+            )
+
+        def _blocksparse_ops_fwd(
+            self,
+            q: torch.Tensor,
+            k: torch.Tensor,
+            v: torch.Tensor,
+            att_mask: Optional[torch.Tensor],
+            scale: float,
+        ) -> torch.Tensor:
+            # Self-attend: (B, nh, S, hs) x (B, nh, hs, S) -> (B, nh, S, S)
+            # When the computations are block sparse, the matrix types change along the way:
+            # - (sparse) attention matrix = (dense) Kt * (dense) Q
+            # NOTE: the 1/sqrt(d) normalization is folded in the softmax scale, saving a pass over Q
+            sqrt_d = math.sqrt(q.size(-1))
+            sparse_att_mat = self.sparse_dot_sdd(q, k)
+
+            # - softmax on the sparse attention matrix, the additive mask being applied on load
+            # (broadcast across the attention matrix blocks row dimension since we assume masking is 1D)
+            sparse_att_mat = blocksparse_softmax(
+                sparse_att_mat,
+                att_mask,
+                self.softmax_lut,
+                self.block_size,
+                scale=scale / sqrt_d,
+                mask_scale=scale,
+                causal=self.causal,
             )
 
-            self.to_gather = []  # use this if different masks per head
-            self.broadcast_to_gather = (
-                []
-            )  # use this if broadcasting same mask across heads
-            num_col_blocks = self.layout.shape[-1]
-            for idx, (h, i, j) in enumerate(zip(*self.layout.nonzero(as_tuple=True))):
-                # assumes per-example masks are 1D, otherwise very expensive
-                self.to_gather.append(h * num_col_blocks + j)
-                self.broadcast_to_gather.append(j)
-
-            self.to_gather = torch.tensor(self.to_gather).long().to(device)
-            self.broadcast_to_gather = (
-                torch.tensor(self.broadcast_to_gather).long().to(device)
+            if self.attn_drop is not None:
+                sparse_att_mat = self.attn_drop(sparse_att_mat)
+
+            # - then (dense) attention is (sparse) attention matrix * dense (value)
+            return self.sparse_dot_dsd(sparse_att_mat, v)
+
+        def _decode(
+            self,
+            q: torch.Tensor,
+            k: torch.Tensor,
+            v: torch.Tensor,
+            att_mask: Optional[torch.Tensor],
+            scale: float,
+        ) -> torch.Tensor:
+            # Only the layout rows right before the end of the keys are live, up to the last key block.
+            # The sparse kernel only pays off if they are sparse enough. The fused decoding kernel has no backward pass
+            seq_len = k.shape[-2]
+            q_start = seq_len - q.shape[-2]
+            n_kv_blocks = -(-seq_len // self.block_size)
+            live_rows = (q_start // self.block_size, n_kv_blocks)
+            if live_rows not in self._decode_sparsity:
+                live_layout = (
+                    self.layout[:, live_rows[0] : live_rows[1], :n_kv_blocks] != 0
+                )
+                self._decode_sparsity[live_rows] = (
+                    1.0 - live_layout.float().mean().item()
+                )
+
+            needs_grad = torch.is_grad_enabled() and any(
+                x.requires_grad for x in (q, k, v)
             )
+            sparse_enough = (
+                self._decode_sparsity[live_rows] > _DECODE_SPARSITY_THRESHOLD
+            )
+            if sparse_enough and self._use_fused_kernel(q) and not needs_grad:
+                return self.flash_blocksparse_fwd(q, k, v, att_mask, scale)
+
+            # Dense attention, the layout being expanded for the live rows, and cut at the end of the keys
+            positions = torch.arange(q_start, seq_len, device=q.device)
+            allowed = self.device_layout[
+                :, positions // self.block_size, :n_kv_blocks
+            ].repeat_interleave(self.block_size, dim=-1)[..., :seq_len]
+
+            if self.causal:
+                allowed = allowed & (
+                    torch.arange(seq_len, device=q.device)[None, :]
+                    <= positions[:, None]
+                )
+
+            att = q @ k.transpose(-2, -1) / math.sqrt(q.size(-1))
+            if att_mask is not None:
+                att = att + att_mask
+
+            att = (scale * att.float()).masked_fill(~allowed, float("-inf"))
+
+            # Rows without any active block are zeroed out, same as the sparse kernels
+            att = torch.softmax(att, dim=-1).nan_to_num(0.0)
+            if self.attn_drop is not None:
+                att = self.attn_drop(att)
+            return att.to(v.dtype) @ v
 
         def forward(
             self,
@@ -154,6 +401,7 @@ if _is_triton_available:
             v: torch.Tensor,
             att_mask=None,
             scale: float = 1.0,
+            kv_scales: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
             *args,
             **kwargs,
         ) -> torch.Tensor:
@@ -161,6 +409,7 @@ if _is_triton_available:
             r"""
             A thin wrap around the Triton blockparse attention operation
 
+            If `kv_scales` are given, K and V are expected to be int8, as returned by `quantize_kv`
             """
 
             # Delayed triton init, to make sure that we get the right device
@@ -168,68 +417,59 @@ if _is_triton_available:
             if not hasattr(self, "sparse_dot_sdd"):
                 self.create_triton_kernels(q.device)
 
-            if att_mask is not None and att_mask.dtype == torch.bool:
-                att_mask = self.update_mask_type(att_mask)
+            # The sequence length is fixed by the layout, and a multiple of the block size by construction.
+            # When decoding (fewer queries than keys), the keys can be shorter, for instance a KV cache being filled
+            q_len, kv_len = q.shape[-2], k.shape[-2]
+            if not (
+                q_len < kv_len <= self._seq_len or q_len == kv_len == self._seq_len
+            ):
+                raise ValueError(
+                    f"Actual sequence sizes (q: {q.shape[-2]}, k: {k.shape[-2]}) and layout "
+                    + f"({self._seq_len}) are inconsistent"
+                )
 
-            assert (
-                q.shape[-2] == k.shape[-2]
-            ), "Blocksparse requires the same dimensions for K and Q for now"
-
-            assert (
-                q.shape[-2] == self.layout.shape[-2] * self.block_size
-            ), "Actual sequence size and layout are inconsistent"
-            assert (
-                k.shape[-2] == self.layout.shape[-2] * self.block_size
-            ), "Actual sequence size and layout are inconsistent"
-
-            assert (
-                q.shape[-2] % self.block_size
-            ) == 0, "Sequence length {}  must be a multiple of block size {}".format(
-                q.shape[-2], self.block_size
+            # mask shape is either (B,1,1,S) or (B,nh,1,S)
+            assert att_mask is None or (
+                att_mask.shape[0] == q.shape[0]
+                and att_mask.shape[1] in [q.shape[1], 1]
+                and att_mask.shape[-1] == k.shape[-2]
             )
 
-            # Blocksparse only works on fp16
-            q_dtype = q.dtype
-            q, k, v = q.half(), k.half(), v.half()
-            if att_mask is not None:
-                att_mask = att_mask.half()
+            return self._compiled_forward(q, k, v, att_mask, scale, kv_scales)
 
-            # Self-attend: (B, nh, S, hs) x (B, nh, hs, S) -> (B, nh, S, S)
-            # When the computations are block sparse, the matrix types change along the way:
-            # - (sparse) attention matrix = (dense) Kt * (dense) Q
-            q = q / math.sqrt(q.size(-1))
-            sparse_att_mat = self.sparse_dot_sdd(q, k)
+        def _forward_impl(
+            self,
+            q: torch.Tensor,
+            k: torch.Tensor,
+            v: torch.Tensor,
+            att_mask: Optional[torch.Tensor],
+            scale: float,
+            kv_scales: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        ) -> torch.Tensor:
+            if att_mask is not None and att_mask.dtype == torch.bool:
+                att_mask = self.update_mask_type(att_mask)
 
-            # apply masks
+            # Blocksparse only works on fp16, skip the casts if the inputs already are
+            q_dtype = q.dtype
+            q = _to_half(q)
+            if kv_scales is None:
+                k, v = _to_half(k), _to_half(v)
             if att_mask is not None:
-                # mask shape is either (B,1,1,S) or (B,nh,1,S)
-                assert (
-                    att_mask.shape[0] == q.shape[0]
-                    and att_mask.shape[1] in [q.shape[1], 1]
-                    and att_mask.shape[-1] == q.shape[-2]
-                )
-                # reshape input mask into blocks
-                block_att_mask = att_mask.reshape(
-                    att_mask.shape[0],
-                    att_mask.shape[1] * att_mask.shape[-1] // self.block_size,
-                    self.block_size,
-                )
-                # gather based on predefined layout
-                if att_mask.shape[1] == 1:
-                    block_att_mask = block_att_mask[:, self.broadcast_to_gather, :]
-                else:
-                    block_att_mask = block_att_mask[:, self.to_gather, :]
-
-                # broadcast across the attention matrix blocks row dimension since we assume masking is 1Di
-                sparse_att_mat += block_att_mask.unsqueeze(-2)
-
-            # - softmax on the sparse attention matrix
-            sparse_att_mat = self.sparse_softmax(
-                sparse_att_mat, scale=scale, is_causal=self.causal
-            )
-
-            sparse_att_mat = self.attn_drop(sparse_att_mat)
-
-            # - then (dense) attention is (sparse) attention matrix * dense (value)
-            a = self.sparse_dot_dsd(sparse_att_mat, v)
-            return a.to(q_dtype)
+                att_mask = _to_half(att_mask)
+
+            if kv_scales is not None:
+                # Quantized K/V, only the fused kernel handles them
+                assert self.kv_quant is not None and self._use_fused_kernel(
+                    q
+                ), "Quantized K/V require kv_quant and the fused kernel"
+                a = self.flash_blocksparse_fwd(q, k, v, att_mask, scale, kv_scales)
+            elif q.shape[-2] < k.shape[-2]:
+                # Decoding: fewer queries than keys
+                a = self._decode(q, k, v, att_mask, scale)
+            elif self._use_fused_kernel(q):
+                # Fast path: the attention matrix is never materialized
+                a = self.flash_blocksparse_fwd(q, k, v, att_mask, scale)
+            else:
+                a = self._blocksparse_ops_fwd(q, k, v, att_mask, scale)
+
+            return a if q_dtype == torch.float16 else a.to(q_dtype)
@@ -0,0 +1,317 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+
+import math
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch.cuda.amp import custom_bwd, custom_fwd
+
+from xformers.triton.k_blocksparse_attention import (
+    get_launch_params,
+    k_block_lut,
+    k_blocksparse_attention_bw_dkdv,
+    k_blocksparse_attention_bw_dq,
+    k_blocksparse_attention_fw,
+)
+
+SUPPORTED_HEAD_DIMS = (16, 32, 64, 128)
+_LUT_BLOCK_N = 64
+
+
+def _to_device(x: torch.Tensor, device) -> torch.Tensor:
+    # Host to device copies go through pinned memory, so that they do not block the host.
+    # Pinning copies the strides, expanded (overlapping) tensors need to be made contiguous first
+    if x.device.type == "cpu" and torch.device(device).type == "cuda":
+        return x.contiguous().pin_memory().to(device, non_blocking=True)
+    return x.to(device)
+
+
+def _mask_strides(mask: Optional[torch.Tensor], ref: torch.Tensor):
+    # mask shape is either (B,1,1,S) or (B,nh,1,S), broadcast over the heads if need be
+    if mask is None:
+        return ref, (0, 0, 0)
+
+    return mask, (
+        mask.stride(0),
+        mask.stride(1) if mask.shape[1] > 1 else 0,
+        mask.stride(-1),
+    )
+
+
+def _attention_fw(q, k, v, mask, row_lut, block, scale, causal, kv_scales=None):
+    B, H, N_CTX_Q, D = q.shape
+    N_KV = k.shape[2]
+    n_blocks = row_lut[2].shape[-1]
+
+    assert (
+        D in SUPPORTED_HEAD_DIMS
+    ), f"Head dimension {D} is not supported, use one of {SUPPORTED_HEAD_DIMS}"
+    assert N_CTX_Q <= N_KV <= n_blocks * block
+    assert q.dtype == torch.float16
+    assert k.dtype == v.dtype == (torch.int8 if kv_scales is not None else q.dtype)
+    if kv_scales is not None:
+        # The kernel indexes the scales as contiguous [batch * heads, seq // block] float32 arrays
+        assert N_KV % block == 0, "Quantized K/V need to be a whole number of blocks"
+        assert all(
+            s.shape == (B, H, N_KV // block)
+            and s.dtype == torch.float32
+            and s.is_contiguous()
+            for s in kv_scales
+        ), "kv_scales are expected to be contiguous float32 [batch, heads, seq // block] tensors"
+
+    # Decoding: there can be fewer queries than keys, in which case the queries are aligned with the end
+    # of the keys, which can themselves be shorter than the layout (KV cache).
+    # Pad the queries to whole row blocks, only these rows of the layout are computed
+    q_start = N_KV - N_CTX_Q
+    pad = q_start % block
+    n_q_blocks = (pad + N_CTX_Q + block - 1) // block
+    pad_end = n_q_blocks * block - pad - N_CTX_Q
+    if pad > 0 or pad_end > 0:
+        q = F.pad(q, (0, 0, pad, pad_end))
+
+    o = torch.empty_like(q)
+    lse = torch.empty((B * H, q.shape[2]), device=q.device, dtype=torch.float32)
+    mask_, mask_strides = _mask_strides(mask, q)
+    k_scale, v_scale = kv_scales if kv_scales is not None else (lse, lse)
+
+    # fmt: off
+    k_blocksparse_attention_fw[(B * H, n_q_blocks)](
+        q, k, v, mask_, o, lse, k_scale, v_scale,
+        *row_lut,
+        q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+        k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+        v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+        o.stride(0), o.stride(1), o.stride(2), o.stride(3),
+        *mask_strides,
+        H, q.shape[2], n_blocks, q_start // block, N_KV,
+        scale / math.sqrt(D), scale,
+        # meta-params, positional since some are autotuning keys
+        block, D, mask is not None, causal, kv_scales is not None, n_q_blocks == n_blocks,
+        N_KV < n_blocks * block,
+        **get_launch_params(block, D),
+    )
+    # fmt: on
+
+    # Outputs for the actual queries
+    return q, o, lse, o[:, :, pad : pad + N_CTX_Q]
+
+
+# Helper to handle the SPMD launch grid and error cases
+class _blocksparse_attention(torch.autograd.Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, q, k, v, mask, row_lut, col_lut, block, scale, causal):
+        q, o, lse, out = _attention_fw(q, k, v, mask, row_lut, block, scale, causal)
+
+        if out.shape[2] < row_lut[2].shape[-1] * block:
+            # Decoding, no backward pass
+            return out
+
+        ctx.save_for_backward(q, k, v, o, lse, mask, *row_lut, *col_lut)
+        ctx.block = block
+        ctx.scale = scale
+        ctx.sm_scale = scale / math.sqrt(q.shape[-1])
+        ctx.causal = causal
+        return o
+
+    @staticmethod
+    @custom_bwd
+    def backward(
+        ctx, grad_out
+    ):  # pragma: no cover  # This is covered, but called from C++ and not tracked
+        (
+            q,
+            k,
+            v,
+            o,
+            lse,
+            mask,
+            *luts,
+        ) = ctx.saved_tensors
+        row_lut, col_lut = luts[:4], luts[4:]
+
+        B, H, N_CTX, D = q.shape
+        n_blocks = N_CTX // ctx.block
+        grad_out = grad_out.contiguous()
+
+        # Row-wise dot product in between the outputs and their gradients, needed for the softmax backward
+        delta = (grad_out.float() * o.float()).sum(dim=-1).reshape(B * H, N_CTX)
+
+        dq = torch.empty(q.shape, device=q.device, dtype=q.dtype)
+        dk = torch.empty(k.shape, device=k.device, dtype=k.dtype)
+        dv = torch.empty(v.shape, device=v.device, dtype=v.dtype)
+        mask_, mask_strides = _mask_strides(mask, q)
+
+        # fmt: off
+        common_args = (
+            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+            v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+            grad_out.stride(0), grad_out.stride(1), grad_out.stride(2), grad_out.stride(3),
+            *mask_strides,
+            H, N_CTX, n_blocks,
+            ctx.sm_scale, ctx.scale,
+        )
+
+        k_blocksparse_attention_bw_dkdv[(B * H, n_blocks)](
+            q, k, v, mask_, grad_out, dk, dv, lse, delta,
+            *col_lut,
+            *common_args,
+            # meta-params, positional since some are autotuning keys
+            ctx.block, D, mask is not None, ctx.causal,
+            **get_launch_params(ctx.block, D, backward=True),
+        )
+
+        k_blocksparse_attention_bw_dq[(B * H, n_blocks)](
+            q, k, v, mask_, grad_out, dq, lse, delta,
+            *row_lut,
+            *common_args,
+            # meta-params, positional since some are autotuning keys
+            ctx.block, D, mask is not None, ctx.causal,
+            **get_launch_params(ctx.block, D, backward=True),
+        )
+        # fmt: on
+
+        return dq, dk, dv, None, None, None, None, None, None
+
+
+def build_block_lut(
+    layout: torch.Tensor, causal: bool = False, transpose: bool = False, device=None
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Ragged lookup table over the active blocks of a [heads, rows, cols] block layout.
+    The active column blocks of the row block `i` for the head `h` are
+    `kv_block_indices[lut_start[h, i] : lut_start[h, i] + lut_count[h, i]]`, in increasing order.
+
+    If causal, the blocks above the diagonal are fully masked and skipped altogether.
+    If transpose, the lookup table is built column-wise (active row blocks per column block) instead.
+
+    `lut_order[h]` lists the row blocks of the head `h` by decreasing number of active blocks,
+    ties being broken by increasing row index. The kernels are scheduled following this order.
+    """
+    device = torch.device(device) if device is not None else layout.device
+
+    # The lookup table is built where the layout lives, typically on the host: the number of active blocks
+    # is then known without a device sync, and the results are copied over asynchronously
+    layout = layout != 0
+
+    if causal:
+        layout = layout.tril()
+
+    if transpose:
+        layout = layout.transpose(-2, -1)
+
+    lut_count = layout.sum(dim=-1, dtype=torch.int32)
+    lut_start = torch.cumsum(lut_count.flatten(), dim=0, dtype=torch.int32).reshape(
+        lut_count.shape
+    )
+    lut_start -= lut_count
+
+    # Heaviest rows first. The sort keys are unique, so that the order does not depend on the sort stability
+    n_rows = lut_count.shape[-1]
+    rows = torch.arange(n_rows, device=layout.device, dtype=torch.int32)
+    lut_order = (
+        torch.argsort(lut_count * n_rows + (n_rows - 1 - rows), dim=-1, descending=True)
+        .int()
+        .contiguous()
+    )
+
+    # CPU fallback
+    if device.type != "cuda":
+        kv_block_indices = layout.nonzero(as_tuple=True)[-1].int()
+        return tuple(  # type: ignore
+            x.to(device) for x in (kv_block_indices, lut_start, lut_count, lut_order)
+        )
+
+    n_active = int(lut_count.sum())
+    layout, lut_start, lut_count, lut_order = (
+        _to_device(x, device)
+        for x in (
+            layout.reshape(-1, layout.shape[-1]).to(torch.int32),
+            lut_start,
+            lut_count,
+            lut_order,
+        )
+    )
+    kv_block_indices = torch.empty(n_active, device=device, dtype=torch.int32)
+
+    # fmt: off
+    k_block_lut[(layout.shape[0],)](
+        layout, kv_block_indices, lut_start,
+        layout.stride(0),
+        layout.shape[1],
+        BLOCK_N=_LUT_BLOCK_N,
+    )
+    # fmt: on
+
+    return kv_block_indices, lut_start, lut_count, lut_order
+
+
+def quantize_kv_blocks(
+    x: torch.Tensor, block: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric int8 quantization of a [batch, heads, seq, head dim] K or V tensor,
+    with one scale per (batch, head, block of `block` tokens).
+    Returns the int8 tensor and the float32 [batch, heads, seq // block] scales.
+    """
+    B, H, N, D = x.shape
+    assert (
+        N % block == 0
+    ), f"The sequence length {N} is not a multiple of the block size {block}"
+    x_ = x.reshape(B, H, N // block, block * D).float()
+
+    scales = x_.abs().amax(dim=-1).clamp_(min=1e-8) / 127.0
+    x_q = (x_ / scales.unsqueeze(-1)).round_().clamp_(-127, 127).to(torch.int8)
+
+    return x_q.reshape(B, H, N, D), scales
+
+
+def blocksparse_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    mask: Optional[torch.Tensor],
+    row_lut: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+    col_lut: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+    block: int,
+    scale: float = 1.0,
+    causal: bool = False,
+    kv_scales: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+) -> torch.Tensor:
+    r"""
+    Fused block-sparse attention, FlashAttention style: the attention matrix is never materialized.
+    The inputs are expected to be [batch, heads, seq, head dim] fp16 tensors,
+    the optional additive mask is [batch, 1 or heads, 1, seq].
+
+    The queries can be shorter than the keys (decoding), they are then aligned with the end of the keys.
+    The keys can also be shorter than the layout (for instance a KV cache), the queries then cover
+    the layout rows right before the end of the keys. This is only supported for inference.
+
+    The lookup tables describe the layout (see `build_block_lut`), and its transpose for the column LUT.
+    If `causal`, both are expected to skip the blocks above the diagonal.
+    The attention follows the blocksparse softmax convention, `softmax(scale * (q.k^T / sqrt(d) + mask))`
+
+    If `kv_scales` are given, K and V are expected to be int8, as returned by `quantize_kv_blocks`,
+    and are dequantized on the fly. This is only supported for inference.
+    """
+    needs_grad = torch.is_grad_enabled() and any(x.requires_grad for x in (q, k, v))
+    assert (
+        q.shape[-2] == k.shape[-2] == row_lut[2].shape[-1] * block or not needs_grad
+    ), "Queries or keys shorter than the layout are only supported for inference"
+
+    if kv_scales is not None:
+        assert not needs_grad, "Quantized K/V are only supported for inference"
+        _, _, _, out = _attention_fw(
+            q, k, v, mask, row_lut, block, scale, causal, kv_scales
+        )
+        return out
+
+    return _blocksparse_attention.apply(
+        q, k, v, mask, row_lut, col_lut, block, scale, causal
+    )
@@ -0,0 +1,90 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+
+from typing import Optional, Tuple
+
+import torch
+from torch.cuda.amp import custom_bwd, custom_fwd
+
+from xformers.triton.blocksparse_attention import _mask_strides
+from xformers.triton.k_blocksparse_softmax import (
+    k_blocksparse_softmax_bw,
+    k_blocksparse_softmax_fw,
+)
+
+
+# Helper to handle the SPMD launch grid and error cases
+class _blocksparse_softmax(torch.autograd.Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, x, mask, lut, block, scale, mask_scale, causal):
+        # x is [batch, active blocks, block, block]
+        assert x.shape[-1] == x.shape[-2] == block
+        x = x.contiguous()
+
+        y = torch.empty_like(x)
+        mask_, mask_strides = _mask_strides(mask, x)
+        block_indices, lut_start, lut_count = lut[:3]
+
+        # fmt: off
+        k_blocksparse_softmax_fw[(lut_count.numel(), x.shape[0])](
+            y, x, mask_,
+            block_indices, lut_start, lut_count,
+            x.stride(0), *mask_strides,
+            lut_count.shape[-1],
+            scale, mask_scale,
+            BLOCK=block,
+            USE_MASK=mask is not None,
+            CAUSAL=causal,
+        )
+        # fmt: on
+
+        ctx.save_for_backward(y, lut_start, lut_count)
+        ctx.block = block
+        ctx.scale = scale
+        return y
+
+    @staticmethod
+    @custom_bwd
+    def backward(
+        ctx, grad_out
+    ):  # pragma: no cover  # This is covered, but called from C++ and not tracked
+        y, lut_start, lut_count = ctx.saved_tensors
+        grad_out = grad_out.contiguous()
+        grad_in = torch.empty_like(y)
+
+        # fmt: off
+        k_blocksparse_softmax_bw[(lut_count.numel(), y.shape[0])](
+            grad_in, grad_out, y,
+            lut_start, lut_count,
+            y.stride(0),
+            ctx.scale,
+            BLOCK=ctx.block,
+        )
+        # fmt: on
+
+        return grad_in, None, None, None, None, None, None
+
+
+def blocksparse_softmax(
+    x: torch.Tensor,
+    mask: Optional[torch.Tensor],
+    lut: Tuple[torch.Tensor, ...],
+    block: int,
+    scale: float = 1.0,
+    mask_scale: float = 1.0,
+    causal: bool = False,
+) -> torch.Tensor:
+    r"""
+    Softmax over the rows of a block-sparse [batch, active blocks, block, block] matrix,
+    as computed by the `sdd` blocksparse matmul, `softmax(x * scale + mask * mask_scale)`.
+
+    The optional additive mask is [batch, 1 or heads, 1, seq], and is applied as the scores are loaded.
+    The lookup table is the non causal row LUT of the layout, see `build_block_lut`.
+    If `causal`, the elements above the diagonal are masked out.
+    Rows without any active element are set to zero.
+    """
+    return _blocksparse_softmax.apply(x, mask, lut, block, scale, mask_scale, causal)
@@ -0,0 +1,578 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+
+import triton
+import triton.language as tl
+
+# CREDITS: This is adapted from the Triton fused attention tutorial, itself a port of FlashAttention
+# https://triton-lang.org/master/getting-started/tutorials/06-fused-attention.html
+# The dense (causal) iteration over the K/V blocks is replaced by a walk over the active blocks of the layout
+
+# NOTE: All the tiles are loaded with explicit strides, K and V being loaded transposed where needed,
+# so that only plain tl.dot calls are required
+
+# NOTE: The lookup tables are ragged, for each (head, row block) the active blocks are
+# kv_block_indices[lut_start: lut_start + lut_count], sorted. When causal, the blocks above the diagonal
+# are not part of the LUT, and the diagonal block is the only one which needs an element-wise masking:
+# it is the last one in the row LUT, and the first one in the column LUT.
+
+# NOTE: The amount of work per row (or column) block varies with the layout, causal ones being triangular.
+# The programs are scheduled heaviest first: the second grid axis walks the LUT order, which lists the blocks
+# of each head by decreasing number of active blocks, so that the lightest ones fill in the tail of the launch
+
+# NOTE: The scores follow the blocksparse softmax convention, `scale * (q.k^T / sqrt(d) + mask)`.
+# This is computed as `q.k^T * sm_scale + mask * mask_scale`, with sm_scale = scale / sqrt(d) and mask_scale = scale
+
+# NOTE: K and V can optionally be quantized to int8 (inference only), with one scale per (batch, head, block).
+# The blocks are dequantized on load, the K scale is folded in the scores and the V scale in the accumulation
+
+# Autotuning the launch parameters is opt-in, since it can take a while on first use.
+# The tile sizes are fixed by the layout block size, only the pipelining and the number of warps are tuned.
+# NOTE: The autotuning keys can only be positional arguments, the meta-parameters which are part of the keys
+# (tile sizes, code paths) are passed positionally by the launchers
+_autotune = os.environ.get("XFORMERS_BSR_AUTOTUNE", "0") == "1"
+
+
+def _autotuned(key):
+    # Without autotuning, the launchers pass the launch parameters from `get_launch_params`
+    if not _autotune:
+        return lambda kernel: kernel
+
+    return triton.autotune(
+        configs=[
+            triton.Config({}, num_stages=stages, num_warps=warps)
+            for stages in [1, 2, 3, 4, 5]
+            for warps in [2, 4, 8]
+        ],
+        key=key,
+    )
+
+
+def get_launch_params(block: int, d_model: int, backward: bool = False):
+    """
+    Default launch parameters for a [block, block] x [block, d_model] tile, similar to the fused matmul ones:
+    more warps for the large blocks, and a shallower pipeline as the tiles grow so that they fit in shared memory.
+    The backward kernels hold more tiles at once and are not pipelined.
+    """
+    if _autotune:
+        return {}
+
+    num_warps = 8 if block >= 128 else 4
+    if backward:
+        num_stages = 1
+    else:
+        num_stages = 4 if block * d_model <= 64 * 64 else 3
+
+    return {"num_warps": num_warps, "num_stages": num_stages}
+
+
+@triton.jit
+def _has_diagonal_block(kv_block_indices, lut_start, lut_count, block_id, LAST):
+    if LAST:
+        offset = lut_start + lut_count - 1
+    else:
+        offset = lut_start
+    return (
+        tl.load(kv_block_indices + offset, mask=lut_count > 0, other=-1) == block_id
+    ).to(tl.int32)
+
+
+# fmt: off
+@triton.jit
+def _fw_inner(
+    acc, l_i, m_i, q,
+    k_base, v_base, mask_base, k_scale_base, v_scale_base,
+    kv_block_indices, lut_lo, lut_hi,
+    offs_m, offs_n, offs_d,
+    stride_kn, stride_kd, stride_vn, stride_vd, stride_mn,
+    sm_scale, mask_scale, N_KV,
+    BLOCK, USE_MASK, CAUSAL_MASK, KV_QUANT, KV_BOUNDS,
+):
+    # fmt: on
+    for idx in range(lut_lo, lut_hi):
+        block_id = tl.load(kv_block_indices + idx)
+        cols = block_id * BLOCK + offs_n
+        kv_valid = cols < N_KV
+        if KV_BOUNDS:
+            # The blocks past the end of the keys are fully masked, their (unused) scale is clamped in bounds
+            scale_id = tl.minimum(block_id, N_KV // BLOCK - 1)
+        else:
+            scale_id = block_id
+
+        # - scores for this block, K being loaded transposed: [BLOCK_DMODEL, BLOCK]
+        k_ptrs = k_base + cols[None, :] * stride_kn + offs_d[:, None] * stride_kd
+        if KV_BOUNDS:
+            k = tl.load(k_ptrs, mask=kv_valid[None, :], other=0)
+        else:
+            k = tl.load(k_ptrs)
+        if KV_QUANT:
+            qk = tl.dot(q, k.to(tl.float16)) * (sm_scale * tl.load(k_scale_base + scale_id))
+        else:
+            qk = tl.dot(q, k) * sm_scale
+
+        if USE_MASK:
+            # additive mask, broadcasted over the rows
+            if KV_BOUNDS:
+                mask = tl.load(mask_base + cols * stride_mn, mask=kv_valid, other=0.0)
+            else:
+                mask = tl.load(mask_base + cols * stride_mn)
+            qk += mask[None, :].to(tl.float32) * mask_scale
+
+        if CAUSAL_MASK:
+            qk = tl.where(offs_m[:, None] >= cols[None, :], qk, float("-inf"))
+
+        if KV_BOUNDS:
+            qk = tl.where(kv_valid[None, :], qk, float("-inf"))
+
+        # - online softmax. Rows which are fully masked so far keep a -inf max, guard the exponentials
+        m_new = tl.maximum(m_i, tl.max(qk, 1))
+        m_safe = tl.where(m_new == float("-inf"), 0.0, m_new)
+        alpha = tl.exp(m_i - m_safe)
+        p = tl.exp(qk - m_safe[:, None])
+        l_i = l_i * alpha + tl.sum(p, 1)
+
+        # - accumulate the (scaled) values
+        v_ptrs = v_base + cols[:, None] * stride_vn + offs_d[None, :] * stride_vd
+        if KV_BOUNDS:
+            v = tl.load(v_ptrs, mask=kv_valid[:, None], other=0)
+        else:
+            v = tl.load(v_ptrs)
+        if KV_QUANT:
+            pv = tl.dot(p.to(tl.float16), v.to(tl.float16)) * tl.load(v_scale_base + scale_id)
+        else:
+            pv = tl.dot(p.to(tl.float16), v)
+        acc = acc * alpha[:, None] + pv
+        m_i = m_new
+
+    return acc, l_i, m_i
+
+
+# fmt: off
+@_autotuned(
+    key=["N_CTX", "N_ROW_BLOCKS", "BLOCK", "BLOCK_DMODEL", "USE_MASK", "CAUSAL", "KV_QUANT", "ORDERED", "KV_BOUNDS"],
+)
+@triton.jit
+def k_blocksparse_attention_fw(
+    Q, K, V, Mask, Out, Lse, K_SCALE, V_SCALE,
+    kv_block_indices, lut_start, lut_count, lut_order,
+    stride_qz, stride_qh, stride_qm, stride_qd,
+    stride_kz, stride_kh, stride_kn, stride_kd,
+    stride_vz, stride_vh, stride_vn, stride_vd,
+    stride_oz, stride_oh, stride_om, stride_od,
+    stride_mz, stride_mh, stride_mn,
+    H, N_CTX, N_ROW_BLOCKS, Q_BLOCK_OFFSET, N_KV,
+    sm_scale, mask_scale,
+    # Meta-params
+    BLOCK: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    USE_MASK: tl.constexpr,
+    CAUSAL: tl.constexpr,
+    KV_QUANT: tl.constexpr,
+    ORDERED: tl.constexpr,
+    KV_BOUNDS: tl.constexpr,
+):
+    # fmt: on
+
+    """
+    Block-sparse attention, forward pass.
+    Each program handles one (batch, head, row block) tuple, and streams the K/V blocks which are active
+    in the layout for this row. Softmax is computed online, the attention matrix is never written out.
+    If ORDERED, the row blocks are scheduled following the LUT order.
+
+    The logsumexp of each row is saved in Lse, for the backward pass to be able to recompute the attention.
+
+    Q can hold fewer rows than the layout (N_CTX vs. N_ROW_BLOCKS * BLOCK), for instance when decoding:
+    the Q rows are then matched with the layout rows starting at Q_BLOCK_OFFSET.
+    K and V hold N_KV rows. If KV_BOUNDS, this is less than the layout (for instance a KV cache being filled),
+    and the columns past N_KV are masked out.
+
+    If KV_QUANT, K and V are int8 and K_SCALE, V_SCALE hold their per (batch, head, block) scales.
+    """
+
+    off_hz = tl.program_id(0)
+    off_z = off_hz // H
+    off_h = off_hz % H
+    if ORDERED:
+        start_m = tl.load(lut_order + off_h * N_ROW_BLOCKS + tl.program_id(1))
+    else:
+        start_m = tl.program_id(1) + Q_BLOCK_OFFSET
+    local_m = start_m - Q_BLOCK_OFFSET
+
+    offs_local_m = local_m * BLOCK + tl.arange(0, BLOCK)
+    offs_m = start_m * BLOCK + tl.arange(0, BLOCK)
+    offs_n = tl.arange(0, BLOCK)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+
+    # The Q tile is loaded once and reused against all the K blocks
+    q_ptrs = (
+        Q + off_z * stride_qz + off_h * stride_qh + offs_local_m[:, None] * stride_qm + offs_d[None, :] * stride_qd
+    )
+    q = tl.load(q_ptrs)
+
+    k_base = K + off_z * stride_kz + off_h * stride_kh
+    v_base = V + off_z * stride_vz + off_h * stride_vh
+    mask_base = Mask + off_z * stride_mz + off_h * stride_mh
+    k_scale_base = K_SCALE + off_hz * (N_KV // BLOCK)
+    v_scale_base = V_SCALE + off_hz * (N_KV // BLOCK)
+
+    # Active column blocks for this (head, row block)
+    lut_row = off_h * N_ROW_BLOCKS + start_m
+    lo = tl.load(lut_start + lut_row)
+    count = tl.load(lut_count + lut_row)
+
+    # Running max, running sum and output accumulator
+    m_i = tl.zeros([BLOCK], dtype=tl.float32) - float("inf")
+    l_i = tl.zeros([BLOCK], dtype=tl.float32)
+    acc = tl.zeros([BLOCK, BLOCK_DMODEL], dtype=tl.float32)
+
+    # - blocks which do not need any causal masking
+    n_unmasked = count
+    if CAUSAL:
+        n_unmasked -= _has_diagonal_block(kv_block_indices, lo, count, start_m, True)
+
+    # fmt: off
+    acc, l_i, m_i = _fw_inner(
+        acc, l_i, m_i, q, k_base, v_base, mask_base, k_scale_base, v_scale_base,
+        kv_block_indices, lo, lo + n_unmasked,
+        offs_m, offs_n, offs_d,
+        stride_kn, stride_kd, stride_vn, stride_vd, stride_mn,
+        sm_scale, mask_scale, N_KV,
+        BLOCK, USE_MASK, False, KV_QUANT, KV_BOUNDS,
+    )
+    # fmt: on
+
+    # - diagonal block, if any
+    if CAUSAL:
+        # fmt: off
+        acc, l_i, m_i = _fw_inner(
+            acc, l_i, m_i, q, k_base, v_base, mask_base, k_scale_base, v_scale_base,
+            kv_block_indices, lo + n_unmasked, lo + count,
+            offs_m, offs_n, offs_d,
+            stride_kn, stride_kd, stride_vn, stride_vd, stride_mn,
+            sm_scale, mask_scale, N_KV,
+            BLOCK, USE_MASK, True, KV_QUANT, KV_BOUNDS,
+        )
+        # fmt: on
+
+    # Rows without any active block are set to zero, same as the sparse matmul would do
+    m_safe = tl.where(m_i == float("-inf"), 0.0, m_i)
+    l_safe = tl.where(l_i == 0.0, 1.0, l_i)
+    acc = acc / l_safe[:, None]
+
+    tl.store(Lse + off_hz * N_CTX + offs_local_m, m_safe + tl.log(l_safe))
+
+    out_ptrs = (
+        Out + off_z * stride_oz + off_h * stride_oh + offs_local_m[:, None] * stride_om + offs_d[None, :] * stride_od
+    )
+    tl.store(out_ptrs, acc.to(tl.float16))
+
+
+# fmt: off
+@triton.jit
+def _bw_dkdv_inner(
+    dk, dv, k, v, mask,
+    q_base, do_base, Lse, Delta,
+    kv_block_indices, lut_lo, lut_hi,
+    offs_m, offs_n, offs_d,
+    stride_qm, stride_qd, stride_dom, stride_dod,
+    off_hz, N_CTX,
+    sm_scale, mask_scale,
+    BLOCK, USE_MASK, CAUSAL_MASK,
+):
+    # fmt: on
+    for idx in range(lut_lo, lut_hi):
+        rows = tl.load(kv_block_indices + idx) * BLOCK + offs_m
+
+        # - recompute the transposed probabilities, [BLOCK(n), BLOCK(m)]
+        q_t = tl.load(q_base + rows[None, :] * stride_qm + offs_d[:, None] * stride_qd)
+        qk_t = tl.dot(k, q_t) * sm_scale
+
+        if USE_MASK:
+            qk_t += mask[:, None]
+
+        if CAUSAL_MASK:
+            qk_t = tl.where(rows[None, :] >= offs_n[:, None], qk_t, float("-inf"))
+
+        lse = tl.load(Lse + off_hz * N_CTX + rows)
+        p_t = tl.exp(qk_t - lse[None, :])
+
+        # - dV += P^T dO
+        do = tl.load(do_base + rows[:, None] * stride_dom + offs_d[None, :] * stride_dod)
+        dv += tl.dot(p_t.to(tl.float16), do)
+
+        # - dS^T = P^T * (V dO^T - delta)
+        do_t = tl.load(do_base + rows[None, :] * stride_dom + offs_d[:, None] * stride_dod)
+        dp_t = tl.dot(v, do_t)
+        delta = tl.load(Delta + off_hz * N_CTX + rows)
+        ds_t = p_t * (dp_t - delta[None, :])
+
+        # - dK += dS^T Q
+        q = tl.load(q_base + rows[:, None] * stride_qm + offs_d[None, :] * stride_qd)
+        dk += tl.dot(ds_t.to(tl.float16), q)
+
+    return dk, dv
+
+
+# fmt: off
+@_autotuned(key=["N_CTX", "N_COL_BLOCKS", "BLOCK", "BLOCK_DMODEL", "USE_MASK", "CAUSAL"])
+@triton.jit
+def k_blocksparse_attention_bw_dkdv(
+    Q, K, V, Mask, DO, DK, DV, Lse, Delta,
+    q_block_indices, lut_start, lut_count, lut_order,
+    stride_qz, stride_qh, stride_qm, stride_qd,
+    stride_kz, stride_kh, stride_kn, stride_kd,
+    stride_vz, stride_vh, stride_vn, stride_vd,
+    stride_doz, stride_doh, stride_dom, stride_dod,
+    stride_mz, stride_mh, stride_mn,
+    H, N_CTX, N_COL_BLOCKS,
+    sm_scale, mask_scale,
+    # Meta-params
+    BLOCK: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    USE_MASK: tl.constexpr,
+    CAUSAL: tl.constexpr,
+):
+    # fmt: on
+
+    """
+    Block-sparse attention, backward pass with respect to K and V.
+    Each program handles one (batch, head, column block) tuple, and walks over the row blocks which
+    attend to it. Everything is computed in the transposed space, so that no atomics are required.
+    The column blocks are scheduled following the LUT order.
+
+    DK and DV are expected to be contiguous, with the same shape as K and V
+    """
+
+    off_hz = tl.program_id(0)
+    off_z = off_hz // H
+    off_h = off_hz % H
+    start_n = tl.load(lut_order + off_h * N_COL_BLOCKS + tl.program_id(1))
+
+    offs_m = tl.arange(0, BLOCK)
+    offs_n = start_n * BLOCK + tl.arange(0, BLOCK)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+
+    k_ptrs = K + off_z * stride_kz + off_h * stride_kh + offs_n[:, None] * stride_kn + offs_d[None, :] * stride_kd
+    v_ptrs = V + off_z * stride_vz + off_h * stride_vh + offs_n[:, None] * stride_vn + offs_d[None, :] * stride_vd
+    k = tl.load(k_ptrs)
+    v = tl.load(v_ptrs)
+
+    if USE_MASK:
+        mask = tl.load(Mask + off_z * stride_mz + off_h * stride_mh + offs_n * stride_mn).to(tl.float32) * mask_scale
+    else:
+        mask = 0.0  # will not be used
+
+    q_base = Q + off_z * stride_qz + off_h * stride_qh
+    do_base = DO + off_z * stride_doz + off_h * stride_doh
+
+    lut_row = off_h * N_COL_BLOCKS + start_n
+    lo = tl.load(lut_start + lut_row)
+    count = tl.load(lut_count + lut_row)
+
+    dk = tl.zeros([BLOCK, BLOCK_DMODEL], dtype=tl.float32)
+    dv = tl.zeros([BLOCK, BLOCK_DMODEL], dtype=tl.float32)
+
+    # - diagonal block first, if any
+    n_masked = 0
+    if CAUSAL:
+        n_masked = _has_diagonal_block(q_block_indices, lo, count, start_n, False)
+        # fmt: off
+        dk, dv = _bw_dkdv_inner(
+            dk, dv, k, v, mask, q_base, do_base, Lse, Delta,
+            q_block_indices, lo, lo + n_masked,
+            offs_m, offs_n, offs_d,
+            stride_qm, stride_qd, stride_dom, stride_dod,
+            off_hz, N_CTX,
+            sm_scale, mask_scale,
+            BLOCK, USE_MASK, True,
+        )
+        # fmt: on
+
+    # - then all the blocks which do not need any causal masking
+    # fmt: off
+    dk, dv = _bw_dkdv_inner(
+        dk, dv, k, v, mask, q_base, do_base, Lse, Delta,
+        q_block_indices, lo + n_masked, lo + count,
+        offs_m, offs_n, offs_d,
+        stride_qm, stride_qd, stride_dom, stride_dod,
+        off_hz, N_CTX,
+        sm_scale, mask_scale,
+        BLOCK, USE_MASK, False,
+    )
+    # fmt: on
+
+    dk = dk * sm_scale
+
+    offs_out = off_hz * N_CTX * BLOCK_DMODEL + offs_n[:, None] * BLOCK_DMODEL + offs_d[None, :]
+    tl.store(DK + offs_out, dk.to(tl.float16))
+    tl.store(DV + offs_out, dv.to(tl.float16))
+
+
+# fmt: off
+@triton.jit
+def _bw_dq_inner(
+    dq, q, do, lse, delta,
+    k_base, v_base, mask_base,
+    kv_block_indices, lut_lo, lut_hi,
+    offs_m, offs_n, offs_d,
+    stride_kn, stride_kd, stride_vn, stride_vd, stride_mn,
+    sm_scale, mask_scale,
+    BLOCK, USE_MASK, CAUSAL_MASK,
+):
+    # fmt: on
+    for idx in range(lut_lo, lut_hi):
+        cols = tl.load(kv_block_indices + idx) * BLOCK + offs_n
+
+        # - recompute the probabilities
+        k_t = tl.load(k_base + cols[None, :] * stride_kn + offs_d[:, None] * stride_kd)
+        qk = tl.dot(q, k_t) * sm_scale
+
+        if USE_MASK:
+            mask = tl.load(mask_base + cols * stride_mn)
+            qk += mask[None, :].to(tl.float32) * mask_scale
+
+        if CAUSAL_MASK:
+            qk = tl.where(offs_m[:, None] >= cols[None, :], qk, float("-inf"))
+
+        p = tl.exp(qk - lse[:, None])
+
+        # - dS = P * (dO V^T - delta)
+        v_t = tl.load(v_base + cols[None, :] * stride_vn + offs_d[:, None] * stride_vd)
+        dp = tl.dot(do, v_t)
+        ds = p * (dp - delta[:, None])
+
+        # - dQ += dS K
+        k = tl.load(k_base + cols[:, None] * stride_kn + offs_d[None, :] * stride_kd)
+        dq += tl.dot(ds.to(tl.float16), k)
+
+    return dq
+
+
+# fmt: off
+@_autotuned(key=["N_CTX", "N_ROW_BLOCKS", "BLOCK", "BLOCK_DMODEL", "USE_MASK", "CAUSAL"])
+@triton.jit
+def k_blocksparse_attention_bw_dq(
+    Q, K, V, Mask, DO, DQ, Lse, Delta,
+    kv_block_indices, lut_start, lut_count, lut_order,
+    stride_qz, stride_qh, stride_qm, stride_qd,
+    stride_kz, stride_kh, stride_kn, stride_kd,
+    stride_vz, stride_vh, stride_vn, stride_vd,
+    stride_doz, stride_doh, stride_dom, stride_dod,
+    stride_mz, stride_mh, stride_mn,
+    H, N_CTX, N_ROW_BLOCKS,
+    sm_scale, mask_scale,
+    # Meta-params
+    BLOCK: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    USE_MASK: tl.constexpr,
+    CAUSAL: tl.constexpr,
+):
+    # fmt: on
+
+    """
+    Block-sparse attention, backward pass with respect to Q.
+    Each program handles one (batch, head, row block) tuple, and walks over the same active blocks as the
+    forward pass. The row blocks are scheduled following the LUT order.
+
+    DQ is expected to be contiguous, with the same shape as Q
+    """
+
+    off_hz = tl.program_id(0)
+    off_z = off_hz // H
+    off_h = off_hz % H
+    start_m = tl.load(lut_order + off_h * N_ROW_BLOCKS + tl.program_id(1))
+
+    offs_m = start_m * BLOCK + tl.arange(0, BLOCK)
+    offs_n = tl.arange(0, BLOCK)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+
+    q_ptrs = Q + off_z * stride_qz + off_h * stride_qh + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qd
+    do_ptrs = DO + off_z * stride_doz + off_h * stride_doh + offs_m[:, None] * stride_dom + offs_d[None, :] * stride_dod
+    q = tl.load(q_ptrs)
+    do = tl.load(do_ptrs)
+    lse = tl.load(Lse + off_hz * N_CTX + offs_m)
+    delta = tl.load(Delta + off_hz * N_CTX + offs_m)
+
+    k_base = K + off_z * stride_kz + off_h * stride_kh
+    v_base = V + off_z * stride_vz + off_h * stride_vh
+    mask_base = Mask + off_z * stride_mz + off_h * stride_mh
+
+    lut_row = off_h * N_ROW_BLOCKS + start_m
+    lo = tl.load(lut_start + lut_row)
+    count = tl.load(lut_count + lut_row)
+
+    dq = tl.zeros([BLOCK, BLOCK_DMODEL], dtype=tl.float32)
+
+    # - blocks which do not need any causal masking
+    n_unmasked = count
+    if CAUSAL:
+        n_unmasked -= _has_diagonal_block(kv_block_indices, lo, count, start_m, True)
+
+    # fmt: off
+    dq = _bw_dq_inner(
+        dq, q, do, lse, delta, k_base, v_base, mask_base,
+        kv_block_indices, lo, lo + n_unmasked,
+        offs_m, offs_n, offs_d,
+        stride_kn, stride_kd, stride_vn, stride_vd, stride_mn,
+        sm_scale, mask_scale,
+        BLOCK, USE_MASK, False,
+    )
+    # fmt: on
+
+    # - diagonal block, if any
+    if CAUSAL:
+        # fmt: off
+        dq = _bw_dq_inner(
+            dq, q, do, lse, delta, k_base, v_base, mask_base,
+            kv_block_indices, lo + n_unmasked, lo + count,
+            offs_m, offs_n, offs_d,
+            stride_kn, stride_kd, stride_vn, stride_vd, stride_mn,
+            sm_scale, mask_scale,
+            BLOCK, USE_MASK, True,
+        )
+        # fmt: on
+
+    dq = dq * sm_scale
+
+    offs_out = off_hz * N_CTX * BLOCK_DMODEL + offs_m[:, None] * BLOCK_DMODEL + offs_d[None, :]
+    tl.store(DQ + offs_out, dq.to(tl.float16))
+
+
+# fmt: off
+@triton.jit
+def k_block_lut(
+    LAYOUT, KV_BLOCK_INDICES, LUT_START,
+    stride_row,
+    N_COLS,
+    # Meta-params
+    BLOCK_N: tl.constexpr,
+):
+    # fmt: on
+
+    """
+    Compact the active blocks of a dense layout into a ragged lookup table.
+    Each program handles one (head, row block) tuple, and writes the indices of the active column blocks
+    at KV_BLOCK_INDICES[LUT_START[row]:], in increasing order.
+
+    LAYOUT is expected to be a [heads * rows, cols] int32 tensor
+    """
+
+    row = tl.program_id(0)
+    offs = tl.arange(0, BLOCK_N)
+
+    start = tl.load(LUT_START + row)
+
+    for col_start in range(0, N_COLS, BLOCK_N):
+        cols = col_start + offs
+        active = tl.load(LAYOUT + row * stride_row + cols, mask=cols < N_COLS, other=0) != 0
+        active_int = active.to(tl.int32)
+
+        # exclusive prefix sum of the active blocks within this chunk, gives the compacted positions
+        positions = tl.sum(tl.where(offs[None, :] < offs[:, None], active_int[None, :], 0), 1)
+        tl.store(KV_BLOCK_INDICES + start + positions, cols, mask=active)
+
+        start += tl.sum(active_int, 0)
@@ -0,0 +1,149 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+import triton
+import triton.language as tl
+
+# NOTE: The sparse attention matrix is [batch, active blocks, BLOCK, BLOCK], the active blocks being ordered
+# as in `layout.nonzero()`. The (non causal) row lookup table of the layout gives, for each (head, row block),
+# the position of its first block in this tensor and the column block of each of them.
+
+# NOTE: The scores follow the same convention as the fused attention, `x * sm_scale + mask * mask_scale`,
+# the additive mask being applied on load, so that the scores are never written back before the softmax
+
+
+# fmt: off
+@triton.jit
+def _masked_scores(
+    x_ptrs, mask_base, block_id,
+    offs_m, offs_n, stride_mn,
+    sm_scale, mask_scale,
+    BLOCK, USE_MASK, CAUSAL,
+):
+    # fmt: on
+    cols = block_id * BLOCK + offs_n
+    x = tl.load(x_ptrs).to(tl.float32) * sm_scale
+
+    if USE_MASK:
+        # additive mask, broadcasted over the rows
+        mask = tl.load(mask_base + cols * stride_mn)
+        x += mask[None, :].to(tl.float32) * mask_scale
+
+    if CAUSAL:
+        x = tl.where(offs_m[:, None] >= cols[None, :], x, float("-inf"))
+
+    return x
+
+
+# fmt: off
+@triton.jit
+def k_blocksparse_softmax_fw(
+    Out, X, Mask,
+    block_indices, lut_start, lut_count,
+    stride_xz, stride_mz, stride_mh, stride_mn,
+    N_ROW_BLOCKS,
+    sm_scale, mask_scale,
+    # Meta-params
+    BLOCK: tl.constexpr,
+    USE_MASK: tl.constexpr,
+    CAUSAL: tl.constexpr,
+):
+    # fmt: on
+
+    """
+    Block-sparse softmax, with an optional additive mask fused in.
+    Each program handles one (head, row block) and one batch entry, the row statistics are computed
+    in a first pass over the active blocks, and the normalized probabilities written out in a second one.
+    """
+
+    lut_row = tl.program_id(0)
+    off_z = tl.program_id(1)
+    off_h = lut_row // N_ROW_BLOCKS
+    start_m = lut_row % N_ROW_BLOCKS
+
+    offs_m = start_m * BLOCK + tl.arange(0, BLOCK)
+    offs_n = tl.arange(0, BLOCK)
+    offs_tile = offs_n[:, None] * BLOCK + offs_n[None, :]
+
+    x_base = X + off_z * stride_xz + offs_tile
+    out_base = Out + off_z * stride_xz + offs_tile
+    mask_base = Mask + off_z * stride_mz + off_h * stride_mh
+
+    lo = tl.load(lut_start + lut_row)
+    hi = lo + tl.load(lut_count + lut_row)
+
+    # - row max and sum, online
+    m_i = tl.zeros([BLOCK], dtype=tl.float32) - float("inf")
+    l_i = tl.zeros([BLOCK], dtype=tl.float32)
+    for idx in range(lo, hi):
+        # fmt: off
+        x = _masked_scores(
+            x_base + idx * BLOCK * BLOCK, mask_base, tl.load(block_indices + idx),
+            offs_m, offs_n, stride_mn,
+            sm_scale, mask_scale,
+            BLOCK, USE_MASK, CAUSAL,
+        )
+        # fmt: on
+
+        # Rows which are fully masked so far keep a -inf max, guard the exponentials
+        m_new = tl.maximum(m_i, tl.max(x, 1))
+        m_safe = tl.where(m_new == float("-inf"), 0.0, m_new)
+        l_i = l_i * tl.exp(m_i - m_safe) + tl.sum(tl.exp(x - m_safe[:, None]), 1)
+        m_i = m_new
+
+    # - normalized probabilities. Fully masked rows are set to zero
+    m_safe = tl.where(m_i == float("-inf"), 0.0, m_i)
+    l_safe = tl.where(l_i == 0.0, 1.0, l_i)
+    for idx in range(lo, hi):
+        # fmt: off
+        x = _masked_scores(
+            x_base + idx * BLOCK * BLOCK, mask_base, tl.load(block_indices + idx),
+            offs_m, offs_n, stride_mn,
+            sm_scale, mask_scale,
+            BLOCK, USE_MASK, CAUSAL,
+        )
+        # fmt: on
+        p = tl.exp(x - m_safe[:, None]) / l_safe[:, None]
+        tl.store(out_base + idx * BLOCK * BLOCK, p)
+
+
+# fmt: off
+@triton.jit
+def k_blocksparse_softmax_bw(
+    GradIn, GradOut, Out,
+    lut_start, lut_count,
+    stride_z,
+    sm_scale,
+    # Meta-params
+    BLOCK: tl.constexpr,
+):
+    # fmt: on
+
+    """
+    Block-sparse softmax, backward pass: `grad_in = sm_scale * y * (grad_out - sum(y * grad_out))`.
+    The additive mask does not change the gradient with respect to the scores.
+    """
+
+    lut_row = tl.program_id(0)
+    off_z = tl.program_id(1)
+
+    offs_n = tl.arange(0, BLOCK)
+    offs_tile = off_z * stride_z + offs_n[:, None] * BLOCK + offs_n[None, :]
+
+    lo = tl.load(lut_start + lut_row)
+    hi = lo + tl.load(lut_count + lut_row)
+
+    # - row-wise dot product in between the outputs and their gradients
+    delta = tl.zeros([BLOCK], dtype=tl.float32)
+    for idx in range(lo, hi):
+        y = tl.load(Out + idx * BLOCK * BLOCK + offs_tile).to(tl.float32)
+        dy = tl.load(GradOut + idx * BLOCK * BLOCK + offs_tile).to(tl.float32)
+        delta += tl.sum(y * dy, 1)
+
+    for idx in range(lo, hi):
+        y = tl.load(Out + idx * BLOCK * BLOCK + offs_tile).to(tl.float32)
+        dy = tl.load(GradOut + idx * BLOCK * BLOCK + offs_tile).to(tl.float32)
+        dx = sm_scale * y * (dy - delta[:, None])
+        tl.store(GradIn + idx * BLOCK * BLOCK + offs_tile, dx)